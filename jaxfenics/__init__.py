@@ -1,5 +1,6 @@
-from .helpers import fenics_to_numpy, numpy_to_fenics
+from .helpers import fenics_to_numpy, numpy_to_fenics, update_fenics_from_numpy
 from .solve import build_jax_solve_eval, build_jax_solve_eval_fwd
 from .solve import solve_eval, vjp_solve_eval_impl, jvp_solve_eval
 from .assemble import build_jax_assemble_eval
 from .assemble import assemble_eval, vjp_assemble_eval, jvp_assemble_eval
+from .assemble import assemble_eval_batch, ScalarFormOutput
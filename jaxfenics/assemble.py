@@ -3,6 +3,10 @@ import ufl
 
 import jax
 import jax.numpy as np
+import numpy as onp
+
+import functools
+import collections
 
 from jax.core import Primitive
 from jax.interpreters.ad import defvjp, defvjp_all
@@ -15,16 +19,27 @@ from .helpers import (
     get_numpy_input_templates,
     check_input,
     convert_all_to_fenics,
+    update_fenics_from_numpy,
 )
 from .helpers import FenicsVariable
 
-from typing import Type, List, Union, Iterable, Callable, Tuple
+from typing import Type, List, Union, Iterable, Callable, Tuple, Optional, Dict
+
+# Above this number of degrees of freedom assembly is memory-bound
+# and aggressive optimization of the generated code mostly adds compile time
+_MEMORY_BOUND_DOFS = 100000
+
+
+# Optional named return type for the FEniCS function wrapped with build_jax_assemble_eval,
+# it is equivalent to returning the plain tuple (value, form)
+ScalarFormOutput = collections.namedtuple("ScalarFormOutput", ["value", "form"])
 
 
 def assemble_eval(
     fenics_function: Callable,
     fenics_templates: Iterable[FenicsVariable],
     *args: np.array,
+    validate: bool = True,
 ) -> Tuple[np.array, ufl.Form, Tuple[FenicsVariable]]:
     """Computes the output of a fenics_function and saves a corresponding gradient tape
     Input:
@@ -32,18 +47,27 @@ def assemble_eval(
         fenics_templates (iterable of FenicsVariable): Templates for converting arrays to FEniCS types
         args (tuple): jax array representation of the input to fenics_function
     Output:
-        numpy_output (np.array): JAX array representation of the output from fenics_function(*fenics_inputs)
+        numpy_output (numpy.ndarray): 0-d host numpy.float64 array with the output from fenics_function(*fenics_inputs)
         residual_form (ufl.Form): UFL Form for the residual used to solve the problem with fenics.solve(F==0, ...)
         fenics_inputs (list of FenicsVariable): FEniCS representation of the input args
+    Checking the output of fenics_function is skipped with validate=False,
+    build_jax_assemble_eval does it once when the function is wrapped.
     """
 
     check_input(fenics_templates, *args)
     fenics_inputs = convert_all_to_fenics(fenics_templates, *args)
 
-    out = fenics_function(*fenics_inputs)
+    numpy_output, ufl_form = _assemble_eval_with_inputs(
+        fenics_function, fenics_inputs, validate=validate
+    )
+    return numpy_output, ufl_form, fenics_inputs
+
+
+def _check_assemble_output(out) -> None:
+    """Checks that the output of FEniCS function is in the form (assembly_output, ufl_form)"""
     if not isinstance(out, tuple):
         raise ValueError(
-            "FEniCS function output should be in the form (assembly_output, ufl_form)."
+            "FEniCS function output should be in the form (assembly_output, ufl_form) or ScalarFormOutput."
         )
 
     assembly_output, ufl_form = out
@@ -63,12 +87,99 @@ def assemble_eval(
             f"FEniCS function output should be in the form (assembly_output, ufl_form). Got {type(ufl_form)} instead of ufl.Form"
         )
 
-    numpy_output = np.asarray(assembly_output)
-    return numpy_output, ufl_form, fenics_inputs
+
+def _assemble_eval_with_inputs(
+    fenics_function: Callable,
+    fenics_inputs: Iterable[FenicsVariable],
+    validate: bool = True,
+) -> Tuple[np.array, ufl.Form]:
+    """Computes the output of a fenics_function for already converted FEniCS inputs"""
+
+    out = fenics_function(*fenics_inputs)
+    if validate:
+        _check_assemble_output(out)
+
+    assembly_output, ufl_form = out
+    # assembly_output is a Python float, keep it on the host
+    numpy_output = onp.array(assembly_output, dtype=onp.float64)
+    return numpy_output, ufl_form
+
+
+def assemble_eval_batch(
+    fenics_function: Callable,
+    fenics_templates: Iterable[FenicsVariable],
+    *args: np.array,
+    validate: bool = True,
+) -> np.array:
+    """Computes the output of a fenics_function for a batch of inputs
+    Input:
+        fenics_function (callable): FEniCS function to be executed during the forward pass
+        fenics_templates (iterable of FenicsVariable): Templates for converting arrays to FEniCS types
+        args (tuple): jax array representation of the input to fenics_function batched along the first axis
+    Output:
+        numpy_output (numpy.ndarray): host array of outputs from fenics_function for each batch element
+    """
+
+    # Stage the batched inputs on the host once, each batch element is then a contiguous row view
+    # instead of a separate device-to-host copy
+    numpy_args = tuple(onp.ascontiguousarray(arg) for arg in args)
+
+    batch_size = numpy_args[0].shape[0]
+    numpy_output, ufl_form, fenics_inputs = assemble_eval(
+        fenics_function,
+        fenics_templates,
+        *(arg[0] for arg in numpy_args),
+        validate=validate,
+    )
+
+    # Remaining batch elements overwrite the values of fenics_inputs in-place
+    # instead of converting to new FEniCS variables, the output always comes from fenics_function
+    outputs = [numpy_output]
+    for b in range(1, batch_size):
+        for fenics_input, arg in zip(fenics_inputs, numpy_args):
+            update_fenics_from_numpy(arg[b], fenics_input)
+        numpy_output, _ = _assemble_eval_with_inputs(
+            fenics_function, fenics_inputs, validate=validate
+        )
+        outputs.append(numpy_output)
+
+    return onp.array(outputs, dtype=onp.float64)
+
+
+def _cached_assemble_eval(
+    forward_cache: dict,
+    fenics_function: Callable,
+    fenics_templates: Iterable[FenicsVariable],
+    *args: np.array,
+    validate: bool = True,
+) -> Tuple[np.array, ufl.Form, Tuple[FenicsVariable]]:
+    """Calls assemble_eval, reusing the result of the previous call if it had the same input args.
+    Only the args are compared, if fenics_function depends on any other state
+    (e.g. a fenics.Constant updated between the calls) the cached result is stale."""
+    numpy_args = tuple(onp.array(arg) for arg in args)
+    cached_args = forward_cache.get("args")
+    if cached_args is not None and all(
+        onp.array_equal(cached_arg, arg)
+        for cached_arg, arg in zip(cached_args, numpy_args)
+    ):
+        numpy_output, ufl_form, fenics_inputs = forward_cache["result"]
+        return numpy_output.copy(), ufl_form, fenics_inputs
+
+    result = assemble_eval(fenics_function, fenics_templates, *args, validate=validate)
+    forward_cache["args"] = numpy_args
+    forward_cache["result"] = result
+    numpy_output, ufl_form, fenics_inputs = result
+    return numpy_output.copy(), ufl_form, fenics_inputs
 
 
 def vjp_assemble_eval(
-    fenics_function: Callable, fenics_templates: FenicsVariable, *args: np.array
+    fenics_function: Callable,
+    fenics_templates: FenicsVariable,
+    *args: np.array,
+    forward_cache: Optional[dict] = None,
+    validate: bool = True,
+    contributes: Optional[Tuple[bool]] = None,
+    form_compiler_parameters: Optional[dict] = None,
 ) -> Tuple[np.array, Callable]:
     """Computes the gradients of the output with respect to the input
     Input:
@@ -79,51 +190,125 @@ def vjp_assemble_eval(
         is a Python callable representing the VJP map from output cotangents to input cotangents.
         The returned VJP function must accept a value with the same shape as the value of fun applied
         to the arguments and must return a tuple with length equal to the number of positional arguments to fun.
+    If forward_cache (dict) is given, the forward pass is reused when it was already computed for the same args.
+    contributes (tuple of bool) tells which inputs appear in the form, it is computed from the form if not given.
+    form_compiler_parameters (dict) are used for compiling the gradient forms.
     """
 
-    numpy_output, ufl_form, fenics_inputs = assemble_eval(
-        fenics_function, fenics_templates, *args
+    if forward_cache is None:
+        numpy_output, ufl_form, fenics_inputs = assemble_eval(
+            fenics_function, fenics_templates, *args, validate=validate
+        )
+    else:
+        numpy_output, ufl_form, fenics_inputs = _cached_assemble_eval(
+            forward_cache, fenics_function, fenics_templates, *args, validate=validate
+        )
+
+    if contributes is None:
+        contributes = _contributing_inputs(ufl_form, fenics_inputs)
+    # Cotangents of the inputs that do not contribute are the same for every call of vjp_fun
+    zeros = tuple(
+        None if contributes[i] else np.zeros(arg.shape, arg.dtype)
+        for i, arg in enumerate(args)
     )
 
     def vjp_fun(g):
-        return tuple(
-            vjp if vjp is not None else jax.ad_util.zeros_like_jaxval(args[i])
-            for i, vjp in enumerate(vjp_assemble_impl(g, ufl_form, fenics_inputs))
+        vjps = vjp_assemble_impl(
+            g, ufl_form, fenics_inputs, contributes, form_compiler_parameters
         )
+        return tuple(vjp if contributes[i] else zeros[i] for i, vjp in enumerate(vjps))
 
     return numpy_output, vjp_fun
 
 
+@functools.lru_cache(maxsize=32)
+def _real_function_space(mesh: fenics.Mesh) -> fenics.FunctionSpace:
+    """Returns the ("Real", 0) function space used to differentiate w.r.t. a fenics.Constant"""
+    return fenics.FunctionSpace(mesh, "Real", 0)
+
+
+def _compile_grad_form(
+    fenics_output_form: ufl.Form,
+    fenics_input: FenicsVariable,
+    form_compiler_parameters: Optional[dict] = None,
+) -> fenics.Form:
+    """Returns the compiled derivative form of fenics_output_form with respect to fenics_input."""
+    # Need to construct direction (test function) first
+    if isinstance(fenics_input, fenics.Function):
+        V = fenics_input.function_space()
+    elif isinstance(fenics_input, fenics.Constant):
+        mesh = fenics_output_form.ufl_domain().ufl_cargo()
+        V = _real_function_space(mesh)
+    else:
+        raise NotImplementedError
+
+    dv = fenics.TestFunction(V)
+    fenics_grad_form = fenics.derivative(fenics_output_form, fenics_input, dv)
+    return fenics.Form(
+        fenics_grad_form, form_compiler_parameters=form_compiler_parameters
+    )
+
+
+def _contributing_inputs(
+    fenics_output_form: ufl.Form, fenics_inputs: List[FenicsVariable]
+) -> Tuple[bool]:
+    """Returns which of the inputs appear as coefficients of fenics_output_form"""
+    form_coefficients = set(fenics_output_form.coefficients())
+    return tuple(fenics_input in form_coefficients for fenics_input in fenics_inputs)
+
+
 # @trace("vjp_assemble_impl")
 def vjp_assemble_impl(
-    g: np.array, fenics_output_form: ufl.Form, fenics_inputs: List[FenicsVariable],
+    g: np.array,
+    fenics_output_form: ufl.Form,
+    fenics_inputs: List[FenicsVariable],
+    contributes: Optional[Tuple[bool]] = None,
+    form_compiler_parameters: Optional[dict] = None,
 ) -> Tuple[np.array]:
-    """Computes the gradients of the output with respect to the inputs."""
-
-    # Compute derivative form for the output with respect to each input
-    fenics_grads_forms = []
-    for fenics_input in fenics_inputs:
-        # Need to construct direction (test function) first
-        if isinstance(fenics_input, fenics.Function):
-            V = fenics_input.function_space()
-        elif isinstance(fenics_input, fenics.Constant):
-            mesh = fenics_output_form.ufl_domain().ufl_cargo()
-            V = fenics.FunctionSpace(mesh, "Real", 0)
-        else:
-            raise NotImplementedError
+    """Computes the gradients of the output with respect to the inputs.
+    Gradients of the inputs not appearing in fenics_output_form are returned as None."""
+
+    if contributes is None:
+        contributes = _contributing_inputs(fenics_output_form, fenics_inputs)
 
-        dv = fenics.TestFunction(V)
-        fenics_grad_form = fenics.derivative(fenics_output_form, fenics_input, dv)
-        fenics_grads_forms.append(fenics_grad_form)
+    # Compute derivative form for the output with respect to each contributing input,
+    # the generated code is loaded from the form compiler cache by the form signature
+    fenics_grads_forms = [
+        _compile_grad_form(fenics_output_form, fenics_input, form_compiler_parameters)
+        for fenics_input, contributes_input in zip(fenics_inputs, contributes)
+        if contributes_input
+    ]
 
     # Assemble the derivative forms
-    fenics_grads = [fenics.assemble(form) for form in fenics_grads_forms]
+    # Assembly is kept serial: DOLFIN holds the GIL during assembly and
+    # its JIT and PETSc objects are not safe to use from several threads
+    assembled_grads = iter(
+        fenics.assemble(form, form_compiler_parameters=form_compiler_parameters)
+        for form in fenics_grads_forms
+    )
+    fenics_grads = [
+        next(assembled_grads) if contributes_input else None
+        for contributes_input in contributes
+    ]
 
     # Convert FEniCS gradients to jax array representation
-    jax_grads = (
-        None if fg is None else np.asarray(g * fenics_to_numpy(fg))
-        for fg in fenics_grads
-    )
+    # JAX traces the VJP function with abstract g, then the scaling has to stay in JAX.
+    # Otherwise fenics_to_numpy returns a fresh host array, so it is scaled by g in-place
+    # and transferred to the device once
+    g_is_tracer = isinstance(g, jax.core.Tracer)
+    if not g_is_tracer:
+        g = onp.asarray(g)
+    jax_grads = []
+    for fg in fenics_grads:
+        if fg is None:
+            jax_grads.append(None)
+            continue
+        fg_numpy = fenics_to_numpy(fg)
+        if g_is_tracer:
+            jax_grads.append(g * jax.device_put(fg_numpy))
+        else:
+            onp.multiply(g, fg_numpy, out=fg_numpy)
+            jax_grads.append(jax.device_put(fg_numpy))
 
     jax_grad_tuple = tuple(jax_grads)
 
@@ -145,44 +330,116 @@ def jvp_assemble_eval(
 
     # Now tangent evaluation!
     fenics_tangents = convert_all_to_fenics(fenics_primals, *tangents)
-    output_tangent_form = 0.0
-    for fp, ft in zip(fenics_primals, fenics_tangents):
-        output_tangent_form += fenics.derivative(output_primal_form, fp, ft)
-
-    if not isinstance(output_tangent_form, float):
-        output_tangent_form = ufl.algorithms.expand_derivatives(output_tangent_form)
-        output_tangent = fenics.assemble(output_tangent_form)
+    # Sum the directional derivatives first and expand them in a single pass
+    output_tangent_form = sum(
+        fenics.derivative(output_primal_form, fp, ft)
+        for fp, ft in zip(fenics_primals, fenics_tangents)
+    )
+    output_tangent_form = ufl.algorithms.expand_derivatives(output_tangent_form)
+    # The tangent form is a functional (rank 0), assembling it returns a float
+    # and no output tensor is allocated
+    output_tangent = fenics.assemble(output_tangent_form)
 
-    jax_output_tangent = output_tangent
+    jax_output_tangent = onp.array(output_tangent, dtype=onp.float64)
 
     return numpy_output_primal, jax_output_tangent
 
 
-def build_jax_assemble_eval(fenics_templates: FenicsVariable) -> Callable:
+def _form_compiler_parameters(fenics_templates: Iterable[FenicsVariable]) -> dict:
+    """Returns the form compiler optimization parameters for gradient forms depending on the problem size"""
+    n_dofs = max(
+        t.function_space().dim() if isinstance(t, fenics.Function) else t.values().size
+        for t in fenics_templates
+    )
+
+    if n_dofs > _MEMORY_BOUND_DOFS:
+        return {"optimize": False, "cpp_optimize": True, "cpp_optimize_flags": "-O2"}
+    return {
+        "optimize": True,
+        "cpp_optimize": True,
+        "cpp_optimize_flags": "-O3 -funroll-loops",
+    }
+
+
+# Decorators returned by build_jax_assemble_eval, keyed by the ids of the templates.
+# Entries are never evicted: the primitives registered with JAX (batching rule and VJP)
+# keep every wrapped function together with its templates and forward cache alive anyway.
+# Since the templates stay alive, their ids cannot be reused by other objects
+_decorator_cache: Dict[Tuple[Tuple[int, ...], bool], Callable] = {}
+
+
+def build_jax_assemble_eval(
+    fenics_templates: FenicsVariable, reuse_forward: bool = False
+) -> Callable:
     """Return `f(*args) = build_jax_assemble_eval(*args)(ofunc(*args))`.
     Given the FEniCS-side function ofunc(*args), return the function
     `f(*args) = build_jax_assemble_eval(*args)(ofunc(*args))` with
     the VJP of `f`, where:
     `*args` are all arguments to `ofunc`.
     Args:
-    ofunc: The FEniCS-side function to be wrapped.
+    ofunc: The FEniCS-side function to be wrapped, returning `(assembly_output, ufl_form)`
+    or equivalently `ScalarFormOutput(value=assembly_output, form=ufl_form)`.
+    Which inputs appear in `ufl_form` is determined once by calling `ofunc` on the templates.
+    `ofunc` must return a form with the same inputs for any input values,
+    the gradients for inputs missing from the templates' form are always zero.
+    reuse_forward: If True, the output of the last forward pass is reused
+    when `f` or its VJP is called again with the same args, e.g. `f(x)` followed by `jax.grad(f)(x)`.
+    Only the args are compared, so `ofunc` must not depend on any other changing state.
+    Comparing the args costs a copy of all inputs per call.
     Returns:
     `f(args) = build_jax_assemble_eval(*args)(ofunc(*args))`
+    Repeated calls with the same templates and ofunc return the same wrapped function.
+    The wrapped functions and their templates are kept alive for the lifetime of the process,
+    so create the templates once instead of in every iteration of a loop.
     """
 
+    decorator_key = (tuple(id(t) for t in fenics_templates), reuse_forward)
+    if decorator_key in _decorator_cache:
+        return _decorator_cache[decorator_key]
+
+    wrapped_functions = {}
+
     def decorator(fenics_function: Callable) -> Callable:
+        if fenics_function in wrapped_functions:
+            return wrapped_functions[fenics_function]
+
+        form_compiler_parameters = _form_compiler_parameters(fenics_templates)
+
+        # Check the output of fenics_function once with the templates as inputs,
+        # the evaluations below then skip the checks
+        template_output = fenics_function(*fenics_templates)
+        _check_assemble_output(template_output)
+
+        # Compile the gradient forms for the templates now. The forms built in later calls
+        # have the same signatures, so the form compiler loads them from its cache
+        _, template_form = template_output
+        template_contributes = _contributing_inputs(template_form, fenics_templates)
+        for template, contributes in zip(fenics_templates, template_contributes):
+            if contributes:
+                _compile_grad_form(template_form, template, form_compiler_parameters)
+
         def jax_assemble_eval(*args):
             return jax_assemble_eval_p.bind(*args)
 
+        # Forward pass shared between the primal and the VJP primitives
+        forward_cache = {} if reuse_forward else None
+
+        def jax_assemble_eval_impl(*args):
+            if forward_cache is None:
+                return assemble_eval(
+                    fenics_function, fenics_templates, *args, validate=False
+                )[0]
+            return _cached_assemble_eval(
+                forward_cache, fenics_function, fenics_templates, *args, validate=False
+            )[0]
+
         jax_assemble_eval_p = Primitive("jax_assemble_eval")
-        jax_assemble_eval_p.def_impl(
-            lambda *args: assemble_eval(fenics_function, fenics_templates, *args)[0]
-        )
+        jax_assemble_eval_p.def_impl(jax_assemble_eval_impl)
 
+        # The output of fenics.assemble for a functional is always a scalar,
+        # so abstract evaluation does not need to run the FEniCS function
         jax_assemble_eval_p.def_abstract_eval(
-            lambda *args: jax.abstract_arrays.make_shaped_array(
-                assemble_eval(fenics_function, fenics_templates, *args)[0]
-            )
+            lambda *args: jax.abstract_arrays.ShapedArray((), onp.float64)
         )
 
         def jax_assemble_eval_batch(vector_arg_values, batch_axes):
@@ -190,8 +447,16 @@ def build_jax_assemble_eval(fenics_templates: FenicsVariable) -> Callable:
             assert (
                 batch_axes[0] == 0
             )  # assert that batch axis is zero, need to rewrite for a general case?
-            res = list(map(jax_assemble_eval, *vector_arg_values))
-            res = np.asarray(res)
+            if any(isinstance(arg, jax.core.Tracer) for arg in vector_arg_values):
+                res = list(map(jax_assemble_eval, *vector_arg_values))
+                res = np.asarray(res)
+            else:
+                res = assemble_eval_batch(
+                    fenics_function,
+                    fenics_templates,
+                    *vector_arg_values,
+                    validate=False,
+                )
             return res, batch_axes[0]
 
         batching.primitive_batchers[jax_assemble_eval_p] = jax_assemble_eval_batch
@@ -203,11 +468,21 @@ def build_jax_assemble_eval(fenics_templates: FenicsVariable) -> Callable:
         djax_assemble_eval_p = Primitive("djax_assemble_eval")
         # djax_assemble_eval_p.multiple_results = True
         djax_assemble_eval_p.def_impl(
-            lambda *args: vjp_assemble_eval(fenics_function, fenics_templates, *args)
+            lambda *args: vjp_assemble_eval(
+                fenics_function,
+                fenics_templates,
+                *args,
+                forward_cache=forward_cache,
+                validate=False,
+                contributes=template_contributes,
+                form_compiler_parameters=form_compiler_parameters,
+            )
         )
 
         defvjp_all(jax_assemble_eval_p, djax_assemble_eval)
 
+        wrapped_functions[fenics_function] = jax_assemble_eval
         return jax_assemble_eval
 
+    _decorator_cache[decorator_key] = decorator
     return decorator
@@ -7,6 +7,26 @@ from typing import Type, List, Union, Iterable, Callable, Tuple
 FenicsVariable = Union[fenics.Constant, fenics.Function]
 
 
+def _vector_to_numpy(fenics_vec):
+    """Copy the global values of FEniCS vector to a new numpy array"""
+    if fenics_vec.mpi_comm().size > 1:
+        data = fenics_vec.gather(np.arange(fenics_vec.size(), dtype="I"))
+    else:
+        data = fenics_vec.get_local()
+    return np.asarray(data)
+
+
+def _numpy_to_vector(numpy_array, fenics_vec):
+    """Copy the local part of global numpy array to FEniCS vector"""
+    fenics_size = fenics_vec.size()
+    range_begin, range_end = fenics_vec.local_range()
+    # get NumPy array instead of JAX because the following slicing and reshaping is extremely slow for JAX arrays
+    local_array = np.asarray(numpy_array).reshape(fenics_size)[range_begin:range_end]
+    # contiguous float64 data is passed to set_local without an extra conversion copy
+    fenics_vec.set_local(np.ascontiguousarray(local_array, dtype=np.float64))
+    fenics_vec.apply("insert")
+
+
 def fenics_to_numpy(fenics_var):
     """Convert FEniCS variable to numpy/jax array.
     Serializes the input so that all processes have the same data."""
@@ -14,19 +34,10 @@ def fenics_to_numpy(fenics_var):
         return np.asarray(fenics_var.values())
 
     if isinstance(fenics_var, fenics.Function):
-        fenics_vec = fenics_var.vector()
-        if fenics_vec.mpi_comm().size > 1:
-            data = fenics_vec.gather(np.arange(fenics_vec.size(), dtype="I"))
-        else:
-            data = fenics_vec.get_local()
-        return np.asarray(data)
+        return _vector_to_numpy(fenics_var.vector())
 
     if isinstance(fenics_var, fenics.GenericVector):
-        if fenics_var.mpi_comm().size > 1:
-            data = fenics_var.gather(np.arange(fenics_var.size(), dtype="I"))
-        else:
-            data = fenics_var.get_local()
-        return np.asarray(data)
+        return _vector_to_numpy(fenics_var)
 
     raise ValueError("Cannot convert " + str(type(fenics_var)))
 
@@ -107,19 +118,39 @@ def numpy_to_fenics(numpy_array, fenics_var_template):
         if isinstance(numpy_array, (jax.abstract_arrays.ConcreteArray,)):
             numpy_array = numpy_array.val
 
-        range_begin, range_end = u.vector().local_range()
         # up to this point `numpy_array` could be JAX array
-        # get NumPy array instead of JAX because the following slicing and reshaping is extremely slow for JAX arrays
-        numpy_array = np.asarray(numpy_array)
-        local_array = numpy_array.reshape(fenics_size)[range_begin:range_end]
-        u.vector().set_local(local_array)
-        u.vector().apply("insert")
+        _numpy_to_vector(numpy_array, u.vector())
         return u
 
     err_msg = f"Cannot convert numpy/jax array to {fenics_var_template}"
     raise ValueError(err_msg)
 
 
+def update_fenics_from_numpy(numpy_array, fenics_var):
+    """Overwrite the values of existing FEniCS variable with numpy/jax array (in-place numpy_to_fenics)"""
+
+    if isinstance(fenics_var, fenics.Constant):
+        fenics_var.assign(numpy_to_fenics(numpy_array, fenics_var))
+        return fenics_var
+
+    if isinstance(fenics_var, fenics.Function):
+        fenics_vec = fenics_var.vector()
+        fenics_size = fenics_vec.size()
+
+        if numpy_array.size != fenics_size:
+            err_msg = (
+                f"Cannot update Function from numpy array:"
+                f"Wrong size {numpy_array.size} vs {fenics_size}"
+            )
+            raise ValueError(err_msg)
+
+        _numpy_to_vector(numpy_array, fenics_vec)
+        return fenics_var
+
+    err_msg = f"Cannot update {fenics_var} from numpy/jax array"
+    raise ValueError(err_msg)
+
+
 def get_numpy_input_templates(
     fenics_input_templates: Iterable[FenicsVariable],
 ) -> List[np.array]:
@@ -0,0 +1,138 @@
+import pytest
+
+import fenics
+import ufl
+
+import jax
+from jax.config import config
+import jax.numpy as np
+import numpy as onp
+
+import fdm
+
+from jaxfenics import build_jax_assemble_eval, jvp_assemble_eval
+from jaxfenics import numpy_to_fenics, fenics_to_numpy
+
+config.update("jax_enable_x64", True)
+fenics.parameters["std_out_all_processes"] = False
+fenics.set_log_level(fenics.LogLevel.ERROR)
+
+mesh = fenics.UnitSquareMesh(3, 2)
+V = fenics.FunctionSpace(mesh, "P", 1)
+
+
+def assemble_fenics(u, kappa0, kappa1):
+
+    f = fenics.Expression(
+        "10*exp(-(pow(x[0] - 0.5, 2) + pow(x[1] - 0.5, 2)) / 0.02)", degree=2
+    )
+
+    inner, grad, dx = ufl.inner, ufl.grad, ufl.dx
+    J_form = 0.5 * inner(kappa0 * grad(u), grad(u)) * dx - kappa1 * f * u * dx
+    J = fenics.assemble(J_form)
+    return J, J_form
+
+
+templates = (fenics.Function(V), fenics.Constant(0.0), fenics.Constant(0.0))
+inputs = (np.ones(V.dim()), np.ones(1) * 0.5, np.ones(1) * 0.6)
+jax_assemble = build_jax_assemble_eval(templates)(assemble_fenics)
+
+
+def test_fenics_forward():
+    fenics_inputs = [numpy_to_fenics(x, t) for x, t in zip(inputs, templates)]
+    expected, _ = assemble_fenics(*fenics_inputs)
+    assert onp.isclose(jax_assemble(*inputs), expected)
+
+
+@pytest.mark.parametrize("argnum", [0, 1, 2])
+def test_fenics_grad(argnum):
+    grad = jax.grad(jax_assemble, argnum)(*inputs)
+
+    def f(x):
+        args = list(inputs)
+        args[argnum] = x
+        return float(jax_assemble(*args))
+
+    direction = onp.random.default_rng(0).normal(size=inputs[argnum].shape)
+    fdm_jvp = fdm.jvp(f, direction)(onp.asarray(inputs[argnum]))
+    assert onp.isclose(np.vdot(grad, direction), fdm_jvp)
+
+
+def test_fenics_vmap():
+    batch_size = 3
+    batched_inputs = tuple(
+        np.stack([x * (1.0 + 0.1 * b) for b in range(batch_size)]) for x in inputs
+    )
+    batched_output = jax.vmap(jax_assemble)(*batched_inputs)
+    expected = [
+        jax_assemble(*(x[b] for x in batched_inputs)) for b in range(batch_size)
+    ]
+    assert onp.allclose(batched_output, expected)
+
+
+def test_reuse_forward():
+    n_calls = [0]
+
+    def counted_assemble_fenics(*fenics_inputs):
+        n_calls[0] += 1
+        return assemble_fenics(*fenics_inputs)
+
+    cached_assemble = build_jax_assemble_eval(templates, reuse_forward=True)(
+        counted_assemble_fenics
+    )
+    n_calls[0] = 0  # do not count the check on the templates
+
+    value = cached_assemble(*inputs)
+    grad = jax.grad(cached_assemble)(*inputs)
+    assert n_calls[0] == 1
+    assert onp.isclose(value, jax_assemble(*inputs))
+    assert onp.allclose(grad, jax.grad(jax_assemble)(*inputs))
+
+    # mutating the returned value does not change the cached result
+    value += 1.0
+    assert onp.isclose(cached_assemble(*inputs), jax_assemble(*inputs))
+    assert n_calls[0] == 1
+
+    # changed input misses the cache
+    changed_inputs = (inputs[0] * 2.0,) + inputs[1:]
+    assert onp.isclose(cached_assemble(*changed_inputs), jax_assemble(*changed_inputs))
+    assert n_calls[0] == 2
+
+
+def test_rewrap_returns_same_function():
+    assert build_jax_assemble_eval(templates)(assemble_fenics) is jax_assemble
+
+
+def assemble_without_kappa(u, kappa):
+    J_form = 0.5 * ufl.inner(u, u) * ufl.dx
+    J = fenics.assemble(J_form)
+    return J, J_form
+
+
+def test_grad_input_absent_from_form():
+    jax_assemble_without_kappa = build_jax_assemble_eval(
+        (fenics.Function(V), fenics.Constant(0.0))
+    )(assemble_without_kappa)
+    u, kappa = inputs[0], inputs[1]
+    du, dkappa = jax.grad(jax_assemble_without_kappa, (0, 1))(u, kappa)
+
+    u_fenics = numpy_to_fenics(u, fenics.Function(V))
+    _, J_form = assemble_without_kappa(u_fenics, fenics.Constant(0.0))
+    expected_du = fenics_to_numpy(fenics.assemble(fenics.derivative(J_form, u_fenics)))
+    assert onp.allclose(du, expected_du)
+    assert onp.allclose(dkappa, onp.zeros_like(kappa))
+
+
+def test_jvp_assemble_eval():
+    rng = onp.random.default_rng(1)
+    tangents = tuple(rng.normal(size=x.shape) for x in inputs)
+    output, output_tangent = jvp_assemble_eval(
+        assemble_fenics, templates, inputs, tangents
+    )
+    assert onp.isclose(output, jax_assemble(*inputs))
+
+    def f(s):
+        return float(jax_assemble(*(x + s[0] * t for x, t in zip(inputs, tangents))))
+
+    fdm_jvp = fdm.jvp(f, onp.ones(1))(onp.zeros(1))
+    assert onp.isclose(output_tangent, fdm_jvp)